@@ -0,0 +1,221 @@
+"""
+Online headway monitoring for CTA buses.
+
+This module keeps, for every pattern (`pid`), the vehicles on it ordered by their distance along the pattern
+(`pdist`) and flags bunching and gaps between consecutive vehicles as new snapshots from `bus.get_vehicles` arrive.
+Only vehicles whose position changed since the previous snapshot are re-inserted, and only the headways next to
+them are re-evaluated, so the fleet is never re-sorted.
+"""
+
+import csv
+import logging
+from bisect import bisect_left, insort
+from collections import defaultdict
+from typing import Dict, List, NamedTuple, Set, TextIO, Tuple, Union
+
+# Distances are in feet, the unit of `pdist`: a quarter mile for bunching and three miles for gaps
+BUNCHING_DISTANCE = 1320
+GAP_DISTANCE = 15840
+# Margin (in feet, 1/20 mile) a flagged headway has to recover past its threshold before the state clears
+HYSTERESIS_DISTANCE = 264
+# Consecutive snapshots a vehicle can be missing from before it is dropped, to ride out failed API calls
+MAX_MISSED_SNAPSHOTS = 2
+
+BUNCHING = 'bunching'
+GAP = 'gap'
+
+
+class HeadwayAlert(NamedTuple):
+    """A single headway event between a vehicle and the one directly ahead of it on the same pattern"""
+    tmstmp: str
+    pid: int
+    vid: str
+    leader: str
+    distance: int
+    kind: str
+
+
+class HeadwayMonitor:
+    """Incrementally tracks the headways of all vehicles per pattern and emits alerts on bunching and gaps.
+
+    Alerts are only emitted when a vehicle enters a bunching or gap state, or when the vehicle ahead of it changes
+    while in that state, so a pair that stays bunched across many snapshots is logged once. A state belongs to the
+    pair rather than to its order, so two bunched vehicles leapfrogging each other continue the same state. A state
+    only clears once the headway moves `hysteresis_distance` past its threshold, so a pair hovering around a threshold
+    is not logged again on every crossing.
+
+    Vehicles missing from a snapshot are kept for `max_missed` snapshots before being dropped, and empty snapshots
+    are ignored altogether, since `bus.call_api` turns failed requests into empty results.
+
+    The same thresholds apply to every pattern regardless of its scheduled frequency, so on low-frequency routes most
+    consecutive pairs will be flagged as gaps.
+
+    :param out_f: An open file to append alerts to as CSV rows. If None, alerts are only returned.
+    :type out_f: TextIO or None
+    :param bunching_distance: Headways (in feet) at or below this are flagged as bunching.
+    :type bunching_distance: int
+    :param gap_distance: Headways (in feet) at or above this are flagged as gaps.
+    :type gap_distance: int
+    :param hysteresis_distance: Margin (in feet) past a threshold a flagged headway needs before its state clears.
+    :type hysteresis_distance: int
+    :param max_missed: Number of consecutive snapshots a vehicle can be missing from before it is dropped.
+    :type max_missed: int
+    :raises ValueError: If the thresholds overlap or `hysteresis_distance` or `max_missed` is negative.
+    """
+
+    def __init__(self, out_f: Union[None, TextIO] = None,
+                 bunching_distance: int = BUNCHING_DISTANCE,
+                 gap_distance: int = GAP_DISTANCE,
+                 hysteresis_distance: int = HYSTERESIS_DISTANCE,
+                 max_missed: int = MAX_MISSED_SNAPSHOTS) -> None:
+        if bunching_distance >= gap_distance:
+            raise ValueError('Parameter `bunching_distance` must be smaller than `gap_distance`')
+        if hysteresis_distance < 0:
+            raise ValueError('Parameter `hysteresis_distance` cannot be negative')
+        if max_missed < 0:
+            raise ValueError('Parameter `max_missed` cannot be negative')
+        self.bunching_distance = bunching_distance
+        self.gap_distance = gap_distance
+        self.hysteresis_distance = hysteresis_distance
+        self.max_missed = max_missed
+        self._writer = csv.writer(out_f) if out_f is not None else None
+        self._out_f = out_f
+        self._positions: Dict[str, Tuple[int, int]] = {}
+        self._tmstmps: Dict[str, str] = {}
+        self._orders: Dict[int, List[Tuple[int, str]]] = defaultdict(list)
+        self._states: Dict[str, Tuple[str, str]] = {}
+        self._missed: Dict[str, int] = {}
+
+    def update(self, vehicles: List[Dict]) -> List[HeadwayAlert]:
+        """Apply a new snapshot of vehicles and return the alerts it triggered.
+
+        :param vehicles: A list of vehicle dictionaries as returned by `bus.get_vehicles` or `bus.get_all_vehicles`.
+                         Vehicles missing from more than `max_missed` consecutive snapshots are dropped, and an
+                         empty snapshot is ignored. Vehicles with a missing or malformed `vid`, `pid`, `pdist` or
+                         `tmstmp` are logged and treated as missing from the snapshot.
+        :type vehicles: List[Dict]
+        :return: The alerts triggered by this snapshot.
+        :rtype: List[HeadwayAlert]
+        """
+        snapshot = []
+        for vehicle in vehicles:
+            try:
+                snapshot.append((str(vehicle['vid']), (int(vehicle['pid']), int(vehicle['pdist'])),
+                                 str(vehicle['tmstmp'])))
+            except (KeyError, TypeError, ValueError) as e:
+                logging.warning(f'Skipping malformed vehicle {vehicle} in headway monitor.\n{e!r}')
+        if not snapshot:
+            return []
+        dirty: Dict[int, Set[str]] = defaultdict(set)
+        seen = set()
+        for vid, position, tmstmp in snapshot:
+            seen.add(vid)
+            self._missed.pop(vid, None)
+            self._tmstmps[vid] = tmstmp
+            old_position = self._positions.get(vid)
+            if old_position == position:
+                continue
+            if old_position is not None:
+                self._remove(vid, dirty)
+            self._insert(vid, position, dirty)
+        for vid in self._positions.keys() - seen:
+            self._missed[vid] = self._missed.get(vid, 0) + 1
+            if self._missed[vid] > self.max_missed:
+                self._remove(vid, dirty)
+                del self._tmstmps[vid]
+                del self._missed[vid]
+                self._states.pop(vid, None)
+
+        alerts = []
+        previous: Dict[str, Union[None, Tuple[str, str]]] = {}
+        for pid in sorted(dirty):
+            vids = sorted(dirty[pid], key=lambda vid: (self._positions.get(vid, (pid, -1))[1], vid))
+            for vid in vids:
+                alert = self._evaluate(pid, vid, previous)
+                if alert is not None:
+                    alerts.append(alert)
+        if self._writer is not None and alerts:
+            self._writer.writerows(alerts)
+            self._out_f.flush()
+        return alerts
+
+    def headways(self, pid: int) -> List[Tuple[str, str, int]]:
+        """Retrieve the current headways on a pattern.
+
+        :param pid: The pattern ID.
+        :type pid: int
+        :return: A list of (vid, leader vid, distance in feet) tuples, ordered from the start of the pattern.
+        :rtype: List[Tuple[str, str, int]]
+        """
+        order = self._orders.get(pid, [])
+        return [(vid, leader, leader_pdist - pdist)
+                for (pdist, vid), (leader_pdist, leader) in zip(order, order[1:])]
+
+    def _insert(self, vid: str, position: Tuple[int, int], dirty: Dict[int, Set[str]]) -> None:
+        pid, pdist = position
+        order = self._orders[pid]
+        insort(order, (pdist, vid))
+        self._positions[vid] = position
+        idx = bisect_left(order, (pdist, vid))
+        dirty[pid].add(vid)
+        if idx > 0:
+            dirty[pid].add(order[idx - 1][1])
+
+    def _remove(self, vid: str, dirty: Dict[int, Set[str]]) -> None:
+        pid, pdist = self._positions.pop(vid)
+        order = self._orders[pid]
+        idx = bisect_left(order, (pdist, vid))
+        del order[idx]
+        if not order:
+            del self._orders[pid]
+        elif idx > 0:
+            dirty[pid].add(order[idx - 1][1])
+
+    def _set_state(self, vid: str, state: Union[None, Tuple[str, str]],
+                   previous: Dict[str, Union[None, Tuple[str, str]]]) -> None:
+        if vid not in previous:
+            previous[vid] = self._states.get(vid)
+        if state is None:
+            self._states.pop(vid, None)
+        else:
+            self._states[vid] = state
+
+    def _pair_state(self, vid: str, leader: str, previous: Dict[str, Union[None, Tuple[str, str]]]) -> Union[None, str]:
+        # States as they were before this snapshot, in either order, so that a swapped pair continues its state
+        state = previous[vid] if vid in previous else self._states.get(vid)
+        if state is not None and state[0] == leader:
+            return state[1]
+        state = previous[leader] if leader in previous else self._states.get(leader)
+        if state is not None and state[0] == vid:
+            return state[1]
+        return None
+
+    def _evaluate(self, pid: int, vid: str,
+                  previous: Dict[str, Union[None, Tuple[str, str]]]) -> Union[None, HeadwayAlert]:
+        position = self._positions.get(vid)
+        if position is None or position[0] != pid:
+            return None
+        order = self._orders[pid]
+        idx = bisect_left(order, (position[1], vid)) + 1
+        if idx == len(order):
+            self._set_state(vid, None, previous)
+            return None
+        leader_pdist, leader = order[idx]
+        distance = leader_pdist - position[1]
+        bunching_distance, gap_distance = self.bunching_distance, self.gap_distance
+        pair_state = self._pair_state(vid, leader, previous)
+        if pair_state == BUNCHING:
+            bunching_distance += self.hysteresis_distance
+        elif pair_state == GAP:
+            gap_distance -= self.hysteresis_distance
+        if distance <= bunching_distance:
+            kind = BUNCHING
+        elif distance >= gap_distance:
+            kind = GAP
+        else:
+            self._set_state(vid, None, previous)
+            return None
+        self._set_state(vid, (leader, kind), previous)
+        if pair_state == kind:
+            return None
+        return HeadwayAlert(self._tmstmps[vid], pid, vid, leader, distance, kind)
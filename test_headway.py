@@ -0,0 +1,153 @@
+import io
+import random
+
+import pytest
+
+import headway
+
+
+def make_vehicle(vid, pdist, pid=1, tmstmp='20240428 12:00:00'):
+    return {'vid': vid, 'pid': pid, 'pdist': pdist, 'tmstmp': tmstmp}
+
+
+def brute_force_headways(snapshot, pid):
+    order = sorted((v['pdist'], v['vid']) for v in snapshot if v['pid'] == pid)
+    return [(vid, leader, leader_pdist - pdist)
+            for (pdist, vid), (leader_pdist, leader) in zip(order, order[1:])]
+
+
+class ReferenceMonitor:
+    """Re-sorts the whole fleet on every snapshot, applying the same alert rules as `headway.HeadwayMonitor`"""
+
+    def __init__(self, bunching_distance, gap_distance, hysteresis_distance, max_missed):
+        self.bunching_distance = bunching_distance
+        self.gap_distance = gap_distance
+        self.hysteresis_distance = hysteresis_distance
+        self.max_missed = max_missed
+        self.fleet = {}
+        self.missed = {}
+        self.states = {}
+
+    def update(self, vehicles):
+        snapshot = [v for v in vehicles if 'pdist' in v]
+        if not snapshot:
+            return []
+        for v in snapshot:
+            self.fleet[v['vid']] = (v['pid'], v['pdist'], v['tmstmp'])
+            self.missed.pop(v['vid'], None)
+        for vid in set(self.fleet) - {v['vid'] for v in snapshot}:
+            self.missed[vid] = self.missed.get(vid, 0) + 1
+            if self.missed[vid] > self.max_missed:
+                del self.fleet[vid], self.missed[vid]
+                self.states.pop(vid, None)
+        previous, self.states = self.states, {}
+        alerts = []
+        for pid in sorted({pid for pid, _, _ in self.fleet.values()}):
+            for vid, leader, distance in brute_force_headways(self.snapshot(), pid):
+                pair_state = None
+                if previous.get(vid, (None,))[0] == leader:
+                    pair_state = previous[vid][1]
+                elif previous.get(leader, (None,))[0] == vid:
+                    pair_state = previous[leader][1]
+                bunching_distance, gap_distance = self.bunching_distance, self.gap_distance
+                if pair_state == headway.BUNCHING:
+                    bunching_distance += self.hysteresis_distance
+                elif pair_state == headway.GAP:
+                    gap_distance -= self.hysteresis_distance
+                if distance <= bunching_distance:
+                    kind = headway.BUNCHING
+                elif distance >= gap_distance:
+                    kind = headway.GAP
+                else:
+                    continue
+                self.states[vid] = (leader, kind)
+                if pair_state != kind:
+                    alerts.append(headway.HeadwayAlert(self.fleet[vid][2], pid, vid, leader, distance, kind))
+        return alerts
+
+    def snapshot(self):
+        return [make_vehicle(vid, pdist, pid=pid) for vid, (pid, pdist, _) in self.fleet.items()]
+
+
+@pytest.mark.parametrize('seed', range(20))
+def test_incremental_monitor_matches_reference(seed):
+    rng = random.Random(seed)
+    settings = dict(bunching_distance=500, gap_distance=5000, hysteresis_distance=200, max_missed=2)
+    monitor = headway.HeadwayMonitor(**settings)
+    reference = ReferenceMonitor(**settings)
+    fleet = {}
+    for tick in range(40):
+        tmstmp = f'20240428 12:{tick:02d}:00'
+        for vid in rng.sample(range(30), 10):
+            vid = str(vid)
+            if vid in fleet and rng.random() < 0.2:
+                del fleet[vid]
+            elif vid in fleet and rng.random() < 0.5:
+                fleet[vid] = make_vehicle(vid, fleet[vid]['pdist'] + rng.randrange(-300, 300, 10),
+                                          pid=fleet[vid]['pid'], tmstmp=tmstmp)
+            else:
+                fleet[vid] = make_vehicle(vid, rng.randrange(0, 20000, 10), pid=rng.choice([1, 2, 3]), tmstmp=tmstmp)
+        snapshot = [v for v in fleet.values() if rng.random() > 0.1]
+        if rng.random() < 0.1:
+            snapshot.append({'vid': '99', 'pid': 1, 'tmstmp': tmstmp})
+        assert monitor.update(snapshot) == reference.update(snapshot)
+        for pid in (1, 2, 3):
+            assert monitor.headways(pid) == brute_force_headways(reference.snapshot(), pid)
+
+
+def test_one_alert_per_state_entry():
+    out_f = io.StringIO()
+    monitor = headway.HeadwayMonitor(out_f)
+    alerts = monitor.update([make_vehicle('a', 0), make_vehicle('b', 1000)])
+    assert alerts == [headway.HeadwayAlert('20240428 12:00:00', 1, 'a', 'b', 1000, headway.BUNCHING)]
+    assert monitor.update([make_vehicle('a', 100), make_vehicle('b', 1200)]) == []
+    assert monitor.update([make_vehicle('a', 100), make_vehicle('b', 5000)]) == []
+    assert len(monitor.update([make_vehicle('a', 4000), make_vehicle('b', 5000)])) == 1
+    assert out_f.getvalue().count('bunching') == 2
+
+
+def test_hysteresis_suppresses_threshold_flapping():
+    monitor = headway.HeadwayMonitor(bunching_distance=1320, hysteresis_distance=264)
+    assert len(monitor.update([make_vehicle('a', 0), make_vehicle('b', 1320)])) == 1
+    assert monitor.update([make_vehicle('a', 0), make_vehicle('b', 1330)]) == []
+    assert monitor.update([make_vehicle('a', 0), make_vehicle('b', 1320)]) == []
+    assert monitor.update([make_vehicle('a', 0), make_vehicle('b', 1600)]) == []
+    assert len(monitor.update([make_vehicle('a', 0), make_vehicle('b', 1320)])) == 1
+
+
+def test_empty_snapshot_keeps_state():
+    snapshot = [make_vehicle('a', 0), make_vehicle('b', 1000)]
+    monitor = headway.HeadwayMonitor()
+    assert len(monitor.update(snapshot)) == 1
+    assert monitor.update([]) == []
+    assert monitor.update(snapshot) == []
+
+
+def test_partial_snapshot_keeps_missing_vehicles_for_grace_period():
+    snapshot = [make_vehicle('a', 0), make_vehicle('b', 1000), make_vehicle('c', 0, pid=2)]
+    monitor = headway.HeadwayMonitor(max_missed=2)
+    assert len(monitor.update(snapshot)) == 1
+    assert monitor.update(snapshot[2:]) == []
+    assert monitor.update(snapshot[2:]) == []
+    assert monitor.update(snapshot) == []
+    for _ in range(3):
+        monitor.update(snapshot[2:])
+    assert monitor.headways(1) == []
+    assert len(monitor.update(snapshot)) == 1
+
+
+def test_swapping_bunched_pair_alerts_once():
+    monitor = headway.HeadwayMonitor()
+    alerts = []
+    for tick in range(6):
+        alerts.extend(monitor.update([make_vehicle('a', 1000 if tick % 2 else 1020), make_vehicle('b', 1010)]))
+    assert len(alerts) == 1
+
+
+def test_malformed_vehicle_does_not_corrupt_state():
+    monitor = headway.HeadwayMonitor()
+    alerts = monitor.update([make_vehicle('a', 0), make_vehicle('b', 100), {'vid': 'c', 'pid': 1, 'tmstmp': ''}])
+    assert alerts == [headway.HeadwayAlert('20240428 12:00:00', 1, 'a', 'b', 100, headway.BUNCHING)]
+    assert monitor.update([make_vehicle('a', 0), make_vehicle('b', 100)]) == []
+    assert monitor.update([make_vehicle('a', 0), make_vehicle('b', 'n/a')]) == []
+    assert monitor.headways(1) == [('a', 'b', 100)]
@@ -1,10 +1,13 @@
-from typing import List, TextIO, Callable
+from typing import Any, List, Dict, TextIO, Callable, Iterable
+from functools import partial
+import logging
 import sched
 import time
 
 import pandas as pd
 
 import bus
+import headway
 import train
 
 
@@ -12,12 +15,18 @@ BUS_CALL_INTERVAL = 150
 TRAIN_CALL_INTERVAL = 30
 BUS_OUTPUT_FILE = 'bus_tracking.csv'
 TRAIN_OUTPUT_FILE = 'train_tracking.csv'
+HEADWAY_OUTPUT_FILE = 'headway_alerts.csv'
 
 
-def track_buses(out_f: TextIO) -> None:
+def track_buses(out_f: TextIO, stages: Iterable[Callable[[List[Dict]], Any]] = ()) -> None:
     vehicles = bus.get_all_vehicles()
     df = pd.DataFrame(vehicles)
     df.to_csv(out_f, header=False, index=False)
+    for stage in stages:
+        try:
+            stage(vehicles)
+        except Exception as e:
+            logging.warning(f'Bus tracking stage {stage} failed.\n{e}')
 
 
 def track_trains(out_f: TextIO) -> None:
@@ -34,8 +43,11 @@ def repeated_tracker(func: Callable[[TextIO], None], scheduler: sched.scheduler,
 def main():
     bus_file = open(BUS_OUTPUT_FILE, 'a')
     train_file = open(TRAIN_OUTPUT_FILE, 'a')
+    headway_file = open(HEADWAY_OUTPUT_FILE, 'a')
+    headway_monitor = headway.HeadwayMonitor(headway_file)
+    bus_tracker = partial(track_buses, stages=[headway_monitor.update])
     scheduler = sched.scheduler(time.time, time.sleep)
-    scheduler.enter(0, 1, repeated_tracker, (track_buses, scheduler, bus_file, BUS_CALL_INTERVAL))
+    scheduler.enter(0, 1, repeated_tracker, (bus_tracker, scheduler, bus_file, BUS_CALL_INTERVAL))
     scheduler.enter(0, 1, repeated_tracker, (track_trains, scheduler, train_file, TRAIN_CALL_INTERVAL))
     try:
         scheduler.run(blocking=True)
@@ -44,6 +56,7 @@ def main():
     finally:
         bus_file.close()
         train_file.close()
+        headway_file.close()
 
 
 if __name__ == '__main__':